@@ -1,53 +1,148 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, StreamingResponse
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response, StreamingResponse
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request as AuthRequest
-import httpx
+import aiohttp
+import asyncio
+import hmac
 import json
+import orjson
 import os
 import time
-from datetime import datetime
-from collections import deque
-from threading import Lock
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 PASSWORD = os.getenv("PASSWORD", "123456")
 GCP_LOCATION = os.getenv("GCP_LOCATION", "us-central1")
 GCP_MODEL = os.getenv("GCP_MODEL", "gemini-2.0-flash-001")
 ALLOWED_ORIGINS = os.getenv("ALLOWED_ORIGINS", "*").split(",")
+PASSWORD_BYTES = PASSWORD.encode()
+BEARER_BYTES = b"Bearer " + PASSWORD_BYTES
+DATA_PREFIX = b"data: "
+# Constant parts of an OpenAI stream chunk; "created" and the delta text are spliced in
+CHUNK_HEAD = b'data: {"id":"chatcmpl-vertex","object":"chat.completion.chunk","created":'
+CHUNK_MODEL = b',"model":' + orjson.dumps(GCP_MODEL) + b',"choices":[{"index":0,"delta":{"content":'
+CHUNK_TAIL = b'},"finish_reason":null}]}\n\n'
+DONE_FRAME = b"data: [DONE]\n\n"
+ERROR_HEAD = b'data: {"error":'
+ERROR_TAIL = b'}\n\n'
 
 GCP_PROJECT_ID = ""
+URL_GENERATE = ""
+URL_STREAM = ""
 credentials_info = None
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=ALLOWED_ORIGINS,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+class Gateway:
+    def __init__(self, app, origins, auth_path):
+        self.app = app
+        self.origins = {o.strip().encode() for o in origins}
+        self.allow_all = b"*" in self.origins
+        self.allow_all_headers = [(b"access-control-allow-origin", b"*")]
+        self.preflight_headers = [
+            (b"access-control-allow-methods", b"DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT"),
+            (b"access-control-max-age", b"600"),
+        ]
+        self.auth_path = auth_path
+        self.unauthorized_body = b'{"detail":"Unauthorized"}'
+        self.unauthorized_headers = [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(self.unauthorized_body)).encode()),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if self.allow_all:
+            cors_headers = self.allow_all_headers
+        else:
+            origin = next((v for k, v in scope["headers"] if k == b"origin"), None)
+            cors_headers = [(b"vary", b"Origin")]
+            if origin in self.origins:
+                cors_headers.append((b"access-control-allow-origin", origin))
+
+        if scope["method"] == "OPTIONS":
+            headers = cors_headers + self.preflight_headers
+            # "*" in Allow-Headers does not cover Authorization, so echo what was asked for
+            requested = next((v for k, v in scope["headers"] if k == b"access-control-request-headers"), None)
+            if requested:
+                headers.append((b"access-control-allow-headers", requested))
+            await send({"type": "http.response.start", "status": 204, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        if scope["path"] == self.auth_path:
+            auth = next((v for k, v in scope["headers"] if k == b"authorization"), b"")
+            if not hmac.compare_digest(auth, BEARER_BYTES):
+                logger.add("warning", f"{scope['method']} {scope['path']} 401")
+                await send({
+                    "type": "http.response.start",
+                    "status": 401,
+                    "headers": cors_headers + self.unauthorized_headers
+                })
+                await send({"type": "http.response.body", "body": self.unauthorized_body})
+                return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # Build a new list: prebuilt responses share their raw_headers
+                message["headers"] = [*message.get("headers", ()), *cors_headers]
+                # Only chat-path 4xx are logged: chat() logs its own 5xx, and a dashboard
+                # tab polling /api/* with a wrong pwd must not flush the buffer
+                status = message["status"]
+                if 400 <= status < 500 and scope["path"] == self.auth_path:
+                    logger.add("warning", f"{scope['method']} {scope['path']} {status}")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+app.add_middleware(Gateway, origins=ALLOWED_ORIGINS, auth_path="/v1/chat/completions")
 
 class MemoryLogger:
     def __init__(self, max_logs=100):
-        self.logs = deque(maxlen=max_logs)
-        self.lock = Lock()
+        self.buf = [None] * max_logs
+        self.n = max_logs
+        self.version = 0
+        # Keeps ETags from an earlier process from matching after a restart
+        self.epoch = int(time.time())
     
+    # Only called from the event loop thread, so no lock is needed
     def add(self, level, message):
-        with self.lock:
-            entry = {
-                "time": datetime.now().strftime("%H:%M:%S"),
-                "level": level,
-                "msg": message[:100]
-            }
-            self.logs.append(entry)
+        self.buf[self.version % self.n] = (time.strftime("%H:%M:%S"), level, message[:100])
+        self.version += 1
+    
+    @property
+    def etag(self):
+        return f'"{self.epoch}-{self.version}"'
+    
+    def entries(self):
+        if self.version < self.n:
+            ordered = self.buf[:self.version]
+        else:
+            start = self.version % self.n
+            ordered = self.buf[start:] + self.buf[:start]
+        return [{"time": t, "level": level, "msg": msg} for t, level, msg in ordered]
 
 logger = MemoryLogger()
+session = None
 access_token = None
+AUTH_HEADERS = None
 token_expiry = 0
+refresh_task = None
+refresh_lock = asyncio.Lock()
+refresh_generation = 0
+
+async def init_credentials():
+    global refresh_generation
+    try:
+        return await load_credentials()
+    finally:
+        # Counts finished attempts, so get_token() waiters can tell one happened
+        refresh_generation += 1
 
-def init_credentials():
-    global access_token, token_expiry, GCP_PROJECT_ID, credentials_info
+async def load_credentials():
+    global access_token, AUTH_HEADERS, token_expiry, GCP_PROJECT_ID, URL_GENERATE, URL_STREAM, credentials_info
     
     json_str = os.getenv("GOOGLE_CREDENTIALS_JSON", "")
     if not json_str:
@@ -60,28 +155,62 @@ def init_credentials():
         if not GCP_PROJECT_ID:
             logger.add("error", "JSON中缺少project_id")
             return False
+        
+        base_url = f"https://{GCP_LOCATION}-aiplatform.googleapis.com/v1/projects/{GCP_PROJECT_ID}/locations/{GCP_LOCATION}/publishers/google/models/{GCP_MODEL}"
+        URL_GENERATE = f"{base_url}:generateContent"
+        URL_STREAM = f"{base_url}:streamGenerateContent"
             
         creds = service_account.Credentials.from_service_account_info(
             credentials_info,
             scopes=["https://www.googleapis.com/auth/cloud-platform"]
         )
-        creds.refresh(AuthRequest())
+        await asyncio.to_thread(creds.refresh, AuthRequest())
         access_token = creds.token
-        token_expiry = time.time() + 1800
+        AUTH_HEADERS = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+        token_expiry = time.monotonic() + 1800
         logger.add("info", f"凭证加载: {GCP_PROJECT_ID[:8]}...")
         return True
     except Exception as e:
         logger.add("error", f"凭证失败: {str(e)}")
         return False
 
-if not init_credentials():
-    logger.add("warning", "启动时未加载凭证，将在首次请求时重试")
+async def refresh_token_loop():
+    while True:
+        await asyncio.sleep(max(60, token_expiry - time.monotonic() - 600))
+        # Until a token has been loaded, chat() and /api/update handle retries
+        if access_token:
+            async with refresh_lock:
+                # /api/update or get_token() may have refreshed while we slept
+                if time.monotonic() >= token_expiry - 600:
+                    await init_credentials()
+
+async def get_token():
+    if time.monotonic() < token_expiry - 300:
+        return AUTH_HEADERS
+    # Concurrent callers wait here for one attempt instead of each starting their own;
+    # if that attempt failed, the waiters fall back to the current headers
+    generation = refresh_generation
+    async with refresh_lock:
+        if refresh_generation == generation and time.monotonic() >= token_expiry - 300:
+            await init_credentials()
+    return AUTH_HEADERS
+
+@app.on_event("startup")
+async def startup():
+    global session, refresh_task
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300),
+        # sock_connect bounds the handshake only; waiting for a free pool slot is unbounded
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=5.0, sock_read=60.0)
+    )
+    if not await init_credentials():
+        logger.add("warning", "启动时未加载凭证，将在首次请求时重试")
+    refresh_task = asyncio.create_task(refresh_token_loop())
 
-def get_token():
-    global access_token, token_expiry
-    if time.time() > token_expiry - 300:
-        init_credentials()
-    return access_token
+@app.on_event("shutdown")
+async def shutdown():
+    refresh_task.cancel()
+    await session.close()
 
 DASHBOARD_HTML = """
 <!DOCTYPE html>
@@ -141,8 +270,15 @@ DASHBOARD_HTML = """
             document.getElementById('cred').innerText = d.cred ? '✅有效' : '❌无效';
         }
         
+        let logsETag = '';
+        
         async function loadLogs() {
-            const r = await fetch('/api/logs?pwd=' + PWD);
+            const r = await fetch('/api/logs?pwd=' + PWD, {
+                cache: 'no-store',
+                headers: logsETag ? {'If-None-Match': logsETag} : {}
+            });
+            if (r.status === 304) return;
+            logsETag = r.headers.get('ETag') || '';
             const logs = await r.json();
             document.getElementById('logs').innerHTML = logs.map(l => 
                 `<div class="log-entry ${l.level}">[${l.time}] ${l.level}: ${l.msg}</div>`
@@ -176,29 +312,42 @@ DASHBOARD_HTML = """
 </html>
 """
 
+DASHBOARD_BYTES = DASHBOARD_HTML.encode("utf-8")
+DASHBOARD_RESPONSE = Response(
+    content=DASHBOARD_BYTES,
+    media_type="text/html",
+    headers={"cache-control": "public, max-age=300"}
+)
+
+def _auth_ok(pwd):
+    return isinstance(pwd, str) and hmac.compare_digest(pwd.encode(errors="surrogatepass"), PASSWORD_BYTES)
+
 @app.get("/", response_class=HTMLResponse)
 async def root():
-    return HTMLResponse(content=DASHBOARD_HTML)
+    return DASHBOARD_RESPONSE
 
 @app.get("/api/status")
 async def status(pwd: str = ""):
-    if pwd != PASSWORD:
+    if not _auth_ok(pwd):
         raise HTTPException(401, "密码错误")
-    return {
+    return ORJSONResponse({
         "project": GCP_PROJECT_ID,
         "model": GCP_MODEL,
         "cred": access_token is not None
-    }
+    })
 
 @app.get("/api/logs")
-async def get_logs(pwd: str = ""):
-    if pwd != PASSWORD:
+async def get_logs(request: Request, pwd: str = ""):
+    if not _auth_ok(pwd):
         raise HTTPException(401, "密码错误")
-    return list(logger.logs)
+    etag = logger.etag
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return ORJSONResponse(logger.entries(), headers={"ETag": etag})
 
 @app.post("/api/update")
 async def update(data: dict):
-    if data.get("pwd") != PASSWORD:
+    if not _auth_ok(data.get("pwd")):
         return {"success": False, "message": "密码错误"}
     try:
         info = json.loads(data.get("json", ""))
@@ -206,29 +355,40 @@ async def update(data: dict):
             return {"success": False, "message": "JSON缺少必要字段"}
         
         os.environ["GOOGLE_CREDENTIALS_JSON"] = data.get("json")
-        if init_credentials():
+        async with refresh_lock:
+            ok = await init_credentials()
+        if ok:
             return {"success": True, "message": f"更新成功！项目ID: {GCP_PROJECT_ID}"}
         else:
             return {"success": False, "message": "JSON格式正确但无法通过Google验证"}
     except Exception as e:
         return {"success": False, "message": str(e)}
 
+def frame_text(line):
+    if not line.startswith(DATA_PREFIX):
+        return ""
+    try:
+        # orjson skips the trailing CR, so the frame is parsed in place
+        data = orjson.loads(memoryview(line)[len(DATA_PREFIX):])
+        candidates = data.get("candidates", [{}])
+        if candidates:
+            parts = candidates[0].get("content", {}).get("parts", [{}])
+            return parts[0].get("text", "")
+    except:
+        pass
+    return ""
+
 @app.post("/v1/chat/completions")
 async def chat(request: Request):
-    auth = request.headers.get("Authorization", "")
-    if auth != f"Bearer {PASSWORD}":
-        raise HTTPException(401, "Unauthorized")
-    
-    if not access_token:
-        if not init_credentials():
-            raise HTTPException(500, "凭证未配置或无效")
+    auth_headers = await get_token()
+    if not auth_headers:
+        raise HTTPException(500, "凭证未配置或无效")
     
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
         is_stream = body.get("stream", False)
         
-        base_url = f"https://{GCP_LOCATION}-aiplatform.googleapis.com/v1/projects/{GCP_PROJECT_ID}/locations/{GCP_LOCATION}/publishers/google/models/{GCP_MODEL}"
-        url = f"{base_url}:streamGenerateContent" if is_stream else f"{base_url}:generateContent"
+        url = URL_STREAM if is_stream else URL_GENERATE
         
         user_text = body.get("messages", [{}])[-1].get("content", "")
         vertex_body = {
@@ -238,47 +398,38 @@ async def chat(request: Request):
                 "maxOutputTokens": body.get("max_tokens", 2048)
             }
         }
+        payload = orjson.dumps(vertex_body)
         
         logger.add("info", f"{'流式' if is_stream else '非流式'}: {user_text[:20]}...")
         
         if is_stream:
             async def stream_response():
+                head = CHUNK_HEAD + str(int(time.time())).encode() + CHUNK_MODEL
                 try:
-                    async with httpx.AsyncClient() as client:
-                        async with client.stream(
-                            "POST", 
-                            url,
-                            headers={"Authorization": f"Bearer {get_token()}"},
-                            json=vertex_body,
-                            timeout=60.0
-                        ) as response:
-                            async for line in response.aiter_lines():
-                                if line and line.startswith("data: "):
-                                    try:
-                                        data = json.loads(line[6:])
-                                        candidates = data.get("candidates", [{}])
-                                        if candidates:
-                                            parts = candidates[0].get("content", {}).get("parts", [{}])
-                                            text = parts[0].get("text", "")
-                                            if text:
-                                                chunk = {
-                                                    "id": "chatcmpl-vertex",
-                                                    "object": "chat.completion.chunk",
-                                                    "created": int(time.time()),
-                                                    "model": GCP_MODEL,
-                                                    "choices": [{
-                                                        "index": 0,
-                                                        "delta": {"content": text},
-                                                        "finish_reason": None
-                                                    }]
-                                                }
-                                                yield f"data: {json.dumps(chunk)}\n\n"
-                                    except:
-                                        continue
-                            yield "data: [DONE]\n\n"
+                    async with session.post(
+                        url,
+                        headers=auth_headers,
+                        data=payload
+                    ) as response:
+                        # Lines are split here rather than with aiohttp's line iterator,
+                        # which rejects any single line over 128 KiB
+                        buf = bytearray()
+                        async for data in response.content.iter_any():
+                            buf += data
+                            if b"\n" not in data:
+                                continue
+                            *lines, buf = buf.split(b"\n")
+                            for line in lines:
+                                text = frame_text(line)
+                                if text:
+                                    yield head + orjson.dumps(text) + CHUNK_TAIL
+                        text = frame_text(buf)
+                        if text:
+                            yield head + orjson.dumps(text) + CHUNK_TAIL
+                        yield DONE_FRAME
                 except Exception as e:
                     logger.add("error", f"流式错误: {str(e)}")
-                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                    yield ERROR_HEAD + orjson.dumps(str(e)) + ERROR_TAIL
             
             return StreamingResponse(
                 stream_response(),
@@ -286,35 +437,33 @@ async def chat(request: Request):
             )
         
         else:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    url,
-                    headers={"Authorization": f"Bearer {get_token()}"},
-                    json=vertex_body,
-                    timeout=60.0
-                )
-                
-                if response.status_code != 200:
-                    logger.add("error", f"Vertex错误: {response.status_code}")
-                    raise HTTPException(response.status_code, response.text)
-                
-                result = response.json()
-                candidates = result.get("candidates", [{}])
-                text = candidates[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+            async with session.post(
+                url,
+                headers=auth_headers,
+                data=payload
+            ) as response:
+                raw = await response.read()
+            if response.status != 200:
+                logger.add("error", f"Vertex错误: {response.status}")
+                raise HTTPException(response.status, raw.decode(errors="replace"))
+            
+            result = orjson.loads(raw)
+            candidates = result.get("candidates", [{}])
+            text = candidates[0].get("content", {}).get("parts", [{}])[0].get("text", "")
                 
-                logger.add("success", f"完成: {text[:20]}...")
+            logger.add("success", f"完成: {text[:20]}...")
                 
-                return {
-                    "id": "chatcmpl-vertex",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": GCP_MODEL,
-                    "choices": [{
-                        "index": 0,
-                        "message": {"role": "assistant", "content": text},
-                        "finish_reason": "stop"
-                    }]
-                }
+            return ORJSONResponse({
+                "id": "chatcmpl-vertex",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": GCP_MODEL,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop"
+                }]
+            })
                 
     except Exception as e:
         logger.add("error", f"处理失败: {str(e)}")
@@ -322,4 +471,4 @@ async def chat(request: Request):
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "project": GCP_PROJECT_ID, "cred_valid": access_token is not None}
+    return ORJSONResponse({"status": "ok", "project": GCP_PROJECT_ID, "cred_valid": access_token is not None})